@@ -0,0 +1,58 @@
+import json
+import atexit
+import queue
+import logging
+import logging.handlers
+from pathlib import Path
+
+# orjson is optional, it only speeds up parsing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONFIG_PATH = Path(__file__).with_name("config.json")
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+_cache = (None, None)  # (mtime_ns, parsed config)
+
+
+def load():
+    """Parse config.json, re-reading it only when the file has changed since the last call"""
+    global _cache
+    mtime = CONFIG_PATH.stat().st_mtime_ns
+    if _cache[0] != mtime:
+        data = CONFIG_PATH.read_bytes()
+        _cache = (mtime, orjson.loads(data) if orjson else json.loads(data))
+    return _cache[1]
+
+
+def setup_logging(logfile_path, console=False):
+    """
+    Configure root logging with timestamps, shared by all scripts.
+    Records are handed to a background thread that does the formatting and file I/O,
+    so logging never blocks the caller on disk (or console) writes.
+    """
+    # The format uses none of these fields, so skip collecting them for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging._srcfile = None
+    
+    file_handler = logging.FileHandler(logfile_path)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        handlers.append(console_handler)
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Drains the queue before exit
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))  # Only merge args; the listener's handlers format
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
@@ -0,0 +1,43 @@
+import tkinter as tk
+from tkinter import simpledialog, messagebox
+
+
+def new_root():
+    """Create the hidden, topmost root window that parents all dialogs"""
+    root = tk.Tk()
+    root.withdraw()  # Hide the main window
+    root.attributes('-topmost', True)  # Bring dialogs to front
+    return root
+
+
+class TicketNumberDialog(simpledialog.Dialog):
+    """Ask for a ticket number; the entry field rejects anything but digits as it is typed"""
+    def __init__(self, parent, initialvalue=""):
+        self.initialvalue = initialvalue
+        super().__init__(parent, "Rename Recording")
+    
+    def body(self, master):
+        tk.Label(master, text="Enter ticket number (digits only):", justify=tk.LEFT).grid(row=0, padx=5, sticky=tk.W)
+        digits_only = master.register(lambda value: value == "" or value.isdigit())
+        self.entry = tk.Entry(master, validate="key", validatecommand=(digits_only, "%P"))
+        self.entry.grid(row=1, padx=5, sticky=tk.W + tk.E)
+        self.entry.insert(0, self.initialvalue)
+        return self.entry
+    
+    def apply(self):
+        self.result = self.entry.get()
+
+
+def ask_ticket_number(parent, initialvalue=""):
+    """Show the ticket dialog and return the entered digits ('' or None if cancelled)"""
+    return TicketNumberDialog(parent, initialvalue).result
+
+
+def show_info(title, message, parent=None):
+    """Show an information message box"""
+    return messagebox.showinfo(title, message, parent=parent)
+
+
+def show_error(title, message, parent=None):
+    """Show an error message box"""
+    return messagebox.showerror(title, message, parent=parent)
@@ -2,70 +2,184 @@ import sys
 import asyncio
 import simpleobsws
 import logging
-import os
-import json
+from pathlib import Path
+import threading
+import config
 
-# Open and read the JSON file
-with open('config.json', 'r') as json_file:
-    cfg = json.loads(json_file.read())
-    host = cfg["host"]
-    port = cfg["port"]
-    password = cfg["password"]
-    scene_name = cfg["scene_name"]
-    input_name = cfg["input_name"]
-    device_id = cfg["device_id"]
+cfg = config.load()
+host = cfg["host"]
+port = cfg["port"]
+password = cfg["password"]
+scene_name = cfg["scene_name"]
+input_name = cfg["input_name"]
+device_id = cfg["device_id"]
 
 
+LOGFILE_PATH = Path(__file__).with_name("logs_obs_control.log")
 
 
-LOGFILE_PATH = os.path.join(os.path.dirname(__file__), "logs_obs_control.log")
+def new_event_loop():
+    """
+    Create the event loop for OBS calls. Only plain TCP WebSockets are used,
+    so Windows does not need the heavier proactor loop.
+    """
+    if sys.platform == "win32":
+        return asyncio.SelectorEventLoop()
+    return asyncio.new_event_loop()
 
 
-# Configure logging with timestamps
-logging.basicConfig(
-    filename=LOGFILE_PATH,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-
-async def main():
-    if len(sys.argv) < 2:
-        logging.warning("Invalid action, use 'start' or 'stop' as arguments")
-        return
-    
-    action = sys.argv[1].lower()
+async def connect():
+    """Open and identify a WebSocket connection to OBS"""
     ws = simpleobsws.WebSocketClient(
         url=f"ws://{host}:{port}",
         password=password
     )
     await ws.connect()
     await ws.wait_until_identified()
+    return ws
 
-    try:
-        if action == "start":
-            logging.info(f"Creating mic input '{input_name}' in scene '{scene_name}'...")
-            await ws.call(simpleobsws.Request("CreateInput", {
-                "sceneName": scene_name,
-                "inputName": input_name,
-                "inputKind": "wasapi_input_capture",
-                "inputSettings": {"device_id": device_id},
-                "sceneItemEnabled": True
-            }))
-            await ws.call(simpleobsws.Request("StartRecord"))
-            logging.info("Recording started")
-
-        elif action == "stop":
-            await ws.call(simpleobsws.Request("StopRecord"))
-            await ws.call(simpleobsws.Request("RemoveInput", {"inputName": input_name}))
-            logging.info("Recording stopped and mic input removed")
-
-        else:
-            logging.error("Invalid action, use 'start' or 'stop' as arguments")
 
+async def start_recording(ws):
+    """Create the mic input and start recording"""
+    logging.info(f"Creating mic input '{input_name}' in scene '{scene_name}'...")
+    # Send both requests in one batch; SerialRealtime keeps CreateInput before StartRecord
+    await ws.call_batch([
+        simpleobsws.Request("CreateInput", {
+            "sceneName": scene_name,
+            "inputName": input_name,
+            "inputKind": "wasapi_input_capture",
+            "inputSettings": {"device_id": device_id},
+            "sceneItemEnabled": True
+        }),
+        simpleobsws.Request("StartRecord")
+    ], execution_type=simpleobsws.RequestBatchExecutionType.SerialRealtime)
+    logging.info("Recording started")
+
+
+async def stop_recording(ws):
+    """Stop recording and remove the mic input, returning the recording's path if OBS reports it"""
+    stop_response, _ = await ws.call_batch([
+        simpleobsws.Request("StopRecord"),
+        simpleobsws.Request("RemoveInput", {"inputName": input_name})
+    ], execution_type=simpleobsws.RequestBatchExecutionType.SerialRealtime)
+    logging.info("Recording stopped and mic input removed")
+    # The file may still be open when StopRecord answers, so callers retry the move;
+    # older obs-websocket versions omit the path
+    if stop_response.ok() and stop_response.responseData:
+        return stop_response.responseData.get("outputPath")
+    return None
+
+
+ACTIONS = {
+    "start": start_recording,
+    "stop": stop_recording,
+}
+
+
+# -----------------------------
+# Persistent controller used by the monitor
+# -----------------------------
+class ObsController:
+    """
+    Keeps a single OBS WebSocket connection open on a background event loop.
+    Requests are submitted from the monitor thread and reconnect on failure.
+    """
+    def __init__(self):
+        self.ws = None
+        self.loop = new_event_loop()
+        # Serializes (re)connects; binds to self.loop on first use since it is only awaited there
+        self.connect_lock = asyncio.Lock()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # Connect eagerly so the handshake is not paid on the first call
+        asyncio.run_coroutine_threadsafe(self._warm_up(), self.loop)
+
+    async def _warm_up(self):
+        try:
+            await self._ensure_connected()
+        except Exception as e:
+            logging.warning(f"OBS not reachable yet, will connect on first call: {e}")
+
+    async def _ensure_connected(self):
+        # Warm-up and queued calls may get here concurrently; only one of them may connect
+        async with self.connect_lock:
+            if self.ws is None or not self.ws.is_identified():
+                await self._disconnect()
+                self.ws = await connect()
+                logging.info("Connected to OBS WebSocket")
+            return self.ws
+
+    async def _disconnect(self):
+        if self.ws is not None:
+            try:
+                await self.ws.disconnect()
+            except Exception:
+                pass
+            self.ws = None
+
+    async def _run(self, action):
+        # One retry with a fresh connection covers OBS restarts between calls
+        for attempt in range(2):
+            try:
+                ws = await self._ensure_connected()
+                return await ACTIONS[action](ws)
+            except Exception as e:
+                logging.warning(f"OBS '{action}' failed (attempt {attempt + 1}/2): {e}")
+                await self._disconnect()
+        logging.error(f"Giving up on OBS '{action}'")
+        return None
+
+    def call(self, action):
+        """
+        Submit 'start' or 'stop' without blocking the caller.
+        The future resolves to the action's result ('stop': the recording path, if known).
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(action), self.loop)
+
+    def close(self):
+        """Disconnect and stop the background event loop"""
+        try:
+            asyncio.run_coroutine_threadsafe(self._disconnect(), self.loop).result(timeout=5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+async def _run_once(action):
+    ws = await connect()
+    try:
+        return await ACTIONS[action](ws)
     finally:
         await ws.disconnect()
 
+
+def run(action):
+    """
+    Connect, perform a single 'start' or 'stop' action and disconnect.
+    Runs on its own event loop, so it can also be used as a threading.Thread target.
+    Returns the action's result ('stop': the recording path, if known).
+    """
+    loop = new_event_loop()
+    try:
+        return loop.run_until_complete(_run_once(action))
+    finally:
+        loop.close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        logging.warning("Invalid action, use 'start' or 'stop' as arguments")
+        return
+
+    action = sys.argv[1].lower()
+    if action not in ACTIONS:
+        logging.error("Invalid action, use 'start' or 'stop' as arguments")
+        return
+
+    run(action)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Configure logging with timestamps (only when run standalone)
+    config.setup_logging(LOGFILE_PATH)
+    main()
@@ -1,51 +1,48 @@
 import time
-import subprocess
 import psutil
 import sys
 import os
 import logging
-import json
+import contextlib
+import enum
 import gc
+import queue
+import random
 import multiprocessing
-from multiprocessing import Queue
-import pythoncom
 from pathlib import Path
-from ctypes import POINTER, cast
-from comtypes import CLSCTX_ALL, CoInitialize, CoUninitialize
-import tkinter as tk
-from tkinter import simpledialog, messagebox
 import threading
+import concurrent.futures
+from collections import OrderedDict
+import config
 
 # -----------------------------
 # Configuration
 # -----------------------------
 
-with open('config.json', 'r') as json_file:
-    cfg = json.loads(json_file.read())
-    POLL_INTERVAL = cfg["poll_interval"]
-    RECORDING_DELAY = cfg["recording_delay"]
-    CALL_DURATION_THRESHOLD = cfg["call_duration_threshold"] 
-    RECORDING_DIR = cfg["obs_recording_path"]
-
 SIPGATE_PROCESS_NAME = "Sipgate.exe"
-OBS_CONTROL_SCRIPT = os.path.join(os.path.dirname(__file__), "obs_control.py")
-PYTHON_EXE = sys.executable  # Use the same Python interpreter
-LOGFILE_PATH = os.path.join(os.path.dirname(__file__), "logs_sipgate_mic_monitor.log")
+SIPGATE_NAME_LOWER = SIPGATE_PROCESS_NAME.lower()  # Compared against lower-cased process names
+STATUS_LOG_INTERVAL = 60  # Seconds between status log lines
+VIDEO_EXTENSIONS = frozenset({'.mkv', '.mp4', '.flv', '.mov'})  # Recording formats, lower-case
+SESSION_RESYNC_INTERVAL = 300  # Seconds between safety re-scans of audio sessions in the worker
+
+# Core Audio enum values (EDataFlow / ERole) for the endpoint Sipgate talks through
+E_CAPTURE = 1
+# Sipgate may record from the default device (eConsole/eMultimedia) or the default
+# communications device; the endpoints of all roles are watched, each device once
+CAPTURE_ROLES = (0, 1, 2)  # eConsole, eMultimedia, eCommunications
+
+LOGFILE_PATH = Path(__file__).with_name("logs_sipgate_mic_monitor.log")
+SELF_PROCESS = psutil.Process(os.getpid())  # Reused by the status log
+
+# Spawned worker processes re-import this module; only the main process owns logging
+IS_MAIN_PROCESS = multiprocessing.current_process().name == 'MainProcess'
 
 # -----------------------------
 # Configure logging
 # -----------------------------
-logging.basicConfig(
-    filename=LOGFILE_PATH,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-# Also log to console for debugging
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-logging.getLogger('').addHandler(console)
+if IS_MAIN_PROCESS:
+    # Also log to console for debugging, only when one is attached (pythonw has no stderr)
+    config.setup_logging(LOGFILE_PATH, console=sys.stderr is not None and sys.stderr.isatty())
 
 # -----------------------------
 # Global uncaught exception hook
@@ -56,7 +53,8 @@ def log_uncaught_exceptions(exc_type, exc_value, exc_traceback):
         return
     logging.critical("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
 
-sys.excepthook = log_uncaught_exceptions
+if IS_MAIN_PROCESS:
+    sys.excepthook = log_uncaught_exceptions
 
 # -----------------------------
 # Recording Rename Handler with Folder Organization
@@ -65,37 +63,40 @@ class RecordingRenamer:
     def __init__(self, recording_dir):
         self.recording_dir = Path(recording_dir)
         self.recording_start_time = None
+        # One hidden Tk root, owned by a dialog thread that is started on first use
+        self.ui_queue = queue.Queue()
+        self.ui_thread = None
+        self.ui_lock = threading.Lock()
+        self.known_folders = set()  # Ticket folders already created or verified this run
+        self.next_numbers = {}  # Ticket folder -> next free recording number
+        self.rename_lock = threading.Lock()  # Guards known_folders, next_numbers and the move
         
     def mark_recording_start(self):
         """Mark the time when recording started"""
-        self.recording_start_time = time.time()
+        self.recording_start_time = time.time()  # Wall clock, compared with file mtimes
         logging.info("Recording start time marked for file tracking")
     
-    def get_latest_recording(self):
-        """Find the most recently created recording file"""
+    def get_latest_recording(self, timeout=2.0):
+        """
+        Find the most recently created recording file.
+        The caller has already waited for OBS to acknowledge the stop, so the file is
+        normally there on the first scan; only if it is not, re-scan briefly until timeout.
+        """
         if not self.recording_start_time:
             logging.warning("No recording start time marked")
             return None
-            
-        time.sleep(2)  # Give OBS time to finalize the file
-        
-        # Check for common video formats
-        video_extensions = ['*.mkv', '*.mp4', '*.flv', '*.mov']
-        all_files = []
         
+        deadline = time.monotonic() + timeout
+        delay = 0.05
         try:
-            for ext in video_extensions:
-                all_files.extend(self.recording_dir.glob(ext))
-            
-            # Filter files created after recording started
-            recent_files = [f for f in all_files if f.stat().st_mtime > self.recording_start_time]
-            
-            if not recent_files:
-                logging.warning("No recording files found after recording start time")
-                return None
+            while (latest := self._scan_latest()) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.warning("No recording files found after recording start time")
+                    return None
+                time.sleep(min(delay, remaining))
+                delay *= 2
             
-            # Return the most recent file
-            latest = max(recent_files, key=lambda x: x.stat().st_mtime)
             logging.info(f"Found latest recording: {latest.name}")
             return latest
             
@@ -103,49 +104,71 @@ class RecordingRenamer:
             logging.error(f"Error finding latest recording: {e}")
             return None
     
+    def _scan_latest(self):
+        """Return the newest recording modified after the recording start, or None"""
+        # One directory pass; DirEntry.stat() is served from the listing on Windows
+        latest = None
+        latest_mtime = self.recording_start_time
+        with os.scandir(self.recording_dir) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() not in VIDEO_EXTENSIONS:
+                    continue
+                mtime = entry.stat().st_mtime
+                if mtime > latest_mtime:
+                    latest, latest_mtime = entry.path, mtime
+        return Path(latest) if latest else None
+    
+    def ui_call(self, dialog, *args, **kwargs):
+        """Run a dialog function from dialogs.py on the dialog thread and return its result"""
+        with self.ui_lock:
+            if self.ui_thread is None:
+                self.ui_thread = threading.Thread(target=self._ui_loop, daemon=True)
+                self.ui_thread.start()
+        done = concurrent.futures.Future()
+        self.ui_queue.put((done, dialog, args, kwargs))
+        return done.result()
+    
+    def _ui_loop(self):
+        """Own a single hidden Tk root (Tk objects must stay on one thread) and run queued dialogs"""
+        try:
+            import dialogs
+            root = dialogs.new_root()
+            error = None
+        except Exception as e:
+            root, error = None, e
+        while True:
+            done, dialog, args, kwargs = self.ui_queue.get()
+            if root is None:
+                done.set_exception(error)
+                continue
+            try:
+                done.set_result(dialog(*args, parent=root, **kwargs))
+            except Exception as e:
+                done.set_exception(e)
+    
     def prompt_for_name(self, default_name=""):
         """Show a dialog to get the ticket number"""
         try:
-            root = tk.Tk()
-            root.withdraw()  # Hide the main window
-            root.attributes('-topmost', True)  # Bring dialog to front
-            
-            ticket_number = simpledialog.askstring(
-                "Rename Recording",
-                "Enter ticket number (digits only):",
-                initialvalue=default_name,
-                parent=root
-            )
-            
-            root.destroy()
-            return ticket_number
+            import dialogs  # Tk is only loaded once the first dialog is needed
+            return self.ui_call(dialogs.ask_ticket_number, initialvalue=default_name)
         except Exception as e:
             logging.error(f"Error showing rename dialog: {e}")
             return None
     
     def get_next_recording_number(self, ticket_folder):
         """Get the next available recording number for this ticket"""
+        if ticket_folder in self.next_numbers:
+            return self.next_numbers[ticket_folder]
         try:
-            # Find all video files in the ticket folder
-            video_extensions = ['*.mkv', '*.mp4', '*.flv', '*.mov']
-            existing_files = []
-            
-            for ext in video_extensions:
-                existing_files.extend(ticket_folder.glob(ext))
-            
-            if not existing_files:
-                return 1
-            
-            # Extract numbers from filenames (format: ticketnumber_XXX.ext)
+            # Extract numbers from filenames (format: ticketnumber_XXX.ext) in one directory pass
             max_number = 0
-            for file in existing_files:
-                stem = file.stem
-                # Try to extract the last part after underscore
-                if '_' in stem:
+            with os.scandir(ticket_folder) as entries:
+                for entry in entries:
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext.lower() not in VIDEO_EXTENSIONS or '_' not in stem:
+                        continue
                     try:
-                        number_part = stem.split('_')[-1]
-                        number = int(number_part)
-                        max_number = max(max_number, number)
+                        max_number = max(max_number, int(stem.rsplit('_', 1)[1]))
                     except ValueError:
                         continue
             
@@ -155,72 +178,113 @@ class RecordingRenamer:
             logging.error(f"Error getting next recording number: {e}")
             return 1
     
+    def move_recording(self, old_path, new_path, attempts=6, delay=0.25):
+        """
+        Move the recording, retrying while OBS still holds the file open.
+        StopRecord can answer before the muxer has closed the file, which
+        makes the rename fail with a sharing violation (PermissionError) on Windows.
+        """
+        for attempt in range(attempts):
+            try:
+                os.replace(old_path, new_path)
+                return
+            except PermissionError:
+                if attempt == attempts - 1:
+                    raise
+                logging.debug(f"Recording still in use, retrying move in {delay:.2f}s")
+                time.sleep(delay)
+                delay *= 2
+    
     def organize_recording(self, old_path, ticket_number):
         """Organize recording into ticket folder with sequential numbering"""
         if not ticket_number:
             logging.info("No ticket number provided, keeping original filename")
             return old_path
         
-        # Validate that ticket_number contains only digits
+        # The dialog only accepts digits, but the number becomes a path component; check anyway
         if not ticket_number.isdigit():
             logging.warning(f"Ticket number '{ticket_number}' contains non-digit characters")
-            try:
-                messagebox.showwarning(
-                    "Invalid Ticket Number",
-                    "Ticket number should contain only digits.\nKeeping original filename."
-                )
-            except:
-                pass
             return old_path
         
         try:
-            # Create ticket folder if it doesn't exist
-            ticket_folder = self.recording_dir / ticket_number
-            ticket_folder.mkdir(exist_ok=True)
-            logging.info(f"Ticket folder ready: {ticket_folder}")
-            
-            # Get the next recording number
-            recording_number = self.get_next_recording_number(ticket_folder)
-            
-            # Create new filename: ticketnumber_XXX.ext
-            old_extension = old_path.suffix
-            new_filename = f"{ticket_number}_{recording_number:03d}{old_extension}"
-            new_path = ticket_folder / new_filename
-            
-            # Move the file
-            old_path.rename(new_path)
+            # Rename threads run concurrently; number selection and move must not interleave
+            with self.rename_lock:
+                # Create ticket folder if it doesn't exist (once per ticket and run)
+                ticket_folder = self.recording_dir / ticket_number
+                if ticket_folder not in self.known_folders:
+                    ticket_folder.mkdir(exist_ok=True)
+                    self.known_folders.add(ticket_folder)
+                    logging.info(f"Ticket folder ready: {ticket_folder}")
+                
+                # Get the next recording number
+                recording_number = self.get_next_recording_number(ticket_folder)
+                
+                # Create new filename: ticketnumber_XXX.ext
+                old_extension = old_path.suffix
+                new_filename = f"{ticket_number}_{recording_number:03d}{old_extension}"
+                new_path = ticket_folder / new_filename
+                if new_path.exists():
+                    # Files were added outside this tool; never overwrite, re-scan instead
+                    self.next_numbers.pop(ticket_folder, None)
+                    recording_number = self.get_next_recording_number(ticket_folder)
+                    new_filename = f"{ticket_number}_{recording_number:03d}{old_extension}"
+                    new_path = ticket_folder / new_filename
+                
+                # Move the file (same volume, so this is a single atomic rename)
+                self.move_recording(old_path, new_path)
+                self.next_numbers[ticket_folder] = recording_number + 1
             logging.info(f"Recording organized: '{old_path.name}' -> '{ticket_number}/{new_filename}'")
             
             # Show success message
             try:
-                messagebox.showinfo(
+                import dialogs
+                self.ui_call(
+                    dialogs.show_info,
                     "Recording Saved",
                     f"Recording saved as:\n{ticket_number}/{new_filename}"
                 )
-            except:
+            except Exception:
                 pass
             
             return new_path
             
         except Exception as e:
             logging.error(f"Error organizing recording: {e}")
+            # Re-check folder and numbering next time
+            with self.rename_lock:
+                self.known_folders.discard(self.recording_dir / ticket_number)
+                self.next_numbers.pop(self.recording_dir / ticket_number, None)
             try:
-                messagebox.showerror("Organization Error", f"Could not organize file: {e}")
-            except:
+                import dialogs
+                self.ui_call(dialogs.show_error, "Organization Error", f"Could not organize file: {e}")
+            except Exception:
                 pass
             return old_path
     
-    def handle_recording_rename(self):
+    def handle_recording_rename(self, stop_future=None):
         """Main function to handle the rename after recording stops"""
         try:
-            # Find the latest recording
-            latest_file = self.get_latest_recording()
+            # Wait for OBS to acknowledge the stop instead of guessing with a sleep
+            output_path = None
+            if stop_future is not None:
+                try:
+                    output_path = stop_future.result(timeout=30)
+                except Exception as e:
+                    logging.warning(f"OBS stop did not complete cleanly: {e}")
+            
+            # Use the path OBS reported; only search the folder if it did not report one
+            if output_path and os.path.isfile(output_path):
+                latest_file = Path(output_path)
+                logging.info(f"OBS reported recording: {latest_file.name}")
+            else:
+                latest_file = self.get_latest_recording()
             
             if not latest_file:
                 logging.error("Could not find recording file to rename")
                 try:
-                    messagebox.showerror("Error", "Could not find the recording file")
-                except:
+                    import dialogs
+                    self.ui_call(dialogs.show_error, "Error", "Could not find the recording file")
+                except Exception:
                     pass
                 return
             
@@ -236,229 +300,415 @@ class RecordingRenamer:
         except Exception as e:
             logging.error(f"Error in handle_recording_rename: {e}", exc_info=True)
 
+# -----------------------------
+# Process lookup helpers
+# -----------------------------
+def find_sipgate_pids(sipgate_name=SIPGATE_NAME_LOWER):
+    """Return the PIDs of all running processes named sipgate_name (lower-case)"""
+    return {
+        p.info['pid'] for p in psutil.process_iter(['pid', 'name'])
+        if p.info['name'] and p.info['name'].lower() == sipgate_name
+    }
+
+
+class ProcessNameCache:
+    """
+    Bounded LRU cache of lower-cased process names keyed by PID.
+    Entries are validated against the process create time so reused PIDs are detected.
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # pid -> (create_time, name)
+        self.lock = threading.Lock()
+
+    def name(self, pid):
+        """Return the lower-cased name of pid; raises psutil errors like psutil.Process"""
+        proc = psutil.Process(pid)
+        create_time = proc.create_time()  # Already fetched by psutil when constructing Process
+        
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry and entry[0] == create_time:
+                self.entries.move_to_end(pid)
+                return entry[1]
+        
+        name = proc.name().lower()
+        with self.lock:
+            self.entries[pid] = (create_time, name)
+            self.entries.move_to_end(pid)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return name
+
+    def discard(self, pid):
+        with self.lock:
+            self.entries.pop(pid, None)
+
+# -----------------------------
+# Sipgate session state tracking
+# -----------------------------
+class SessionStateTracker:
+    """
+    Tracks the state of every watched Sipgate capture session and publishes
+    the combined active flag into shared memory whenever it changes.
+    COM callbacks arrive on different threads, so all updates take the lock.
+    """
+    def __init__(self, mic_active, state_changed):
+        self.mic_active = mic_active
+        self.state_changed = state_changed
+        self.lock = threading.Lock()
+        self.states = {}
+        self.published = None
+
+    def update(self, key, active, publish=True):
+        """Record a session's state; publish=False defers publishing to a later publish()"""
+        with self.lock:
+            self.states[key] = active
+            if publish:
+                self._publish()
+
+    def remove(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+            self._publish()
+
+    def publish(self):
+        with self.lock:
+            self._publish()
+
+    def reset(self):
+        """Forget all sessions without publishing, e.g. while switching devices"""
+        with self.lock:
+            self.states.clear()
+
+    def _publish(self):
+        active = any(self.states.values())
+        if active != self.published:
+            self.published = active
+            # Write the flag before signalling so the reader never sees a stale value
+            self.mic_active.value = active
+            self.state_changed.set()
+
 # -----------------------------
 # Isolated COM worker process
 # -----------------------------
-def com_worker_process(queue):
+def com_worker_process(stop_event, mic_active, state_changed, ready, sipgate_name, resync_interval):
     """
     Separate process to handle COM operations.
     This completely isolates COM from the main process.
-    Enhanced with better error handling and resource management.
+    Instead of polling, Sipgate's capture sessions are watched through
+    WASAPI session notifications; state changes are written to mic_active
+    and announced through state_changed. ready is set once COM is initialised
+    and the initial state has been published; setting stop_event shuts it down.
+    Settings are passed in by the parent so the worker does not depend on module config.
     """
-    # Import pycaw only in the worker process
+    # Import COM modules only in the worker process; the parent never touches COM.
+    # pythoncom and comtypes initialize COM on import using sys.coinit_flags (STA by default),
+    # which would make the MTA initialization below fail with RPC_E_CHANGED_MODE
+    sys.coinit_flags = 0  # COINIT_MULTITHREADED
     try:
+        import pythoncom
+        from ctypes import POINTER, cast
+        from comtypes import CLSCTX_ALL, COMError
         from pycaw.pycaw import AudioUtilities, IAudioSessionManager2, IAudioSessionControl2
+        from pycaw.utils import AudioSession
+        from pycaw.callbacks import AudioSessionEvents, AudioSessionNotification, MMNotificationClient
     except ImportError as e:
-        print(f"COM worker failed to import pycaw: {e}")
+        print(f"COM worker failed to import COM modules: {e}")
         return
     
-    # Initialize COM for this process
+    # Initialize COM for this process (MTA so callbacks arrive without a message pump)
     try:
-        pythoncom.CoInitialize()
+        pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
     except Exception as e:
         print(f"COM worker failed to initialize: {e}")
         return
     
+    # Commands for the worker loop: REBUILD from COM callbacks, EXIT once stop_event is set
+    commands = queue.Queue()
+    threading.Thread(target=lambda: (stop_event.wait(), commands.put("EXIT")), daemon=True).start()
+    
+    tracker = SessionStateTracker(mic_active, state_changed)
+    process_names = ProcessNameCache()
+    watched = {}  # Instance identifier -> AudioSession with a registered watcher, kept alive so callbacks stay registered
+    watched_lock = threading.Lock()  # Session-created callbacks race with the walk in attach()
+    
+    class SipgateSessionWatcher(AudioSessionEvents):
+        """Forwards state changes of one Sipgate session to the tracker"""
+        def __init__(self):
+            super().__init__()
+            self.key = id(self)
+        
+        def on_state_changed(self, new_state, new_state_id):
+            tracker.update(self.key, new_state_id == 1)  # 0=inactive, 1=active, 2=expired
+        
+        def on_session_disconnected(self, disconnect_reason, disconnect_reason_id):
+            tracker.remove(self.key)
+    
+    def watch_if_sipgate(session):
+        """Register a state watcher on the session (a pycaw AudioSession) if it belongs to Sipgate"""
+        pid = session.ProcessId
+        try:
+            if process_names.name(pid) != sipgate_name:
+                return
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            process_names.discard(pid)
+            return
+        watch_session(session, pid)
+    
+    def watch_session(session, pid, publish=True):
+        """Register a state watcher on a known Sipgate session (a pycaw AudioSession), once per session"""
+        instance_id = session.InstanceIdentifier
+        with watched_lock:
+            if instance_id in watched:
+                return  # Seen by both the enumeration and the session-created callback
+            watcher = SipgateSessionWatcher()
+            session.register_notification(watcher)
+            watched[instance_id] = session
+        tracker.update(watcher.key, session.State == 1, publish)
+        print(f"COM worker watching Sipgate session (PID {pid})")
+    
+    class NewSessionListener(AudioSessionNotification):
+        """Picks up Sipgate sessions created after the worker started"""
+        def on_session_created(self, new_session):
+            # pycaw has already queried IAudioSessionControl2 and wrapped it in an AudioSession
+            try:
+                watch_if_sipgate(new_session)
+            except Exception as e:
+                print(f"COM worker failed to watch new session: {e}")
+    
+    class DefaultDeviceListener(MMNotificationClient):
+        """Asks the worker loop to re-attach when a default capture device changes"""
+        def on_default_device_changed(self, flow, flow_id, role, role_id, default_device_id):
+            if flow_id == E_CAPTURE and role_id in CAPTURE_ROLES:
+                commands.put("REBUILD")
+    
     enumerator = None
-    mic = None
-    session_manager = None
+    device_listener = None
+    endpoints = []  # (session manager, session listener) per watched capture device
     
-    try:
-        # Pre-initialize COM objects to reduce per-check overhead
-        enumerator = AudioUtilities.GetDeviceEnumerator()
-        mic = enumerator.GetDefaultAudioEndpoint(1, 1)  # 1=capture, 1=communications
+    def attach():
+        """Bind to the default capture endpoints and watch their Sipgate sessions"""
+        # Resolve Sipgate's PIDs once so the session walk only compares integers
+        sipgate_pids = find_sipgate_pids(sipgate_name)
+        device_ids = set()
+        for role in CAPTURE_ROLES:
+            mic = enumerator.GetDefaultAudioEndpoint(E_CAPTURE, role)
+            device_id = mic.GetId()
+            if device_id in device_ids:
+                continue  # Same device as another role's default
+            device_ids.add(device_id)
+            attach_endpoint(mic, sipgate_pids)
+        
+        # Report the current state, even if no Sipgate session exists yet
+        tracker.publish()
+    
+    def attach_endpoint(mic, sipgate_pids):
+        """Watch the Sipgate sessions of one capture endpoint"""
         session_manager = mic.Activate(IAudioSessionManager2._iid_, CLSCTX_ALL, None)
         session_manager = cast(session_manager, POINTER(IAudioSessionManager2))
         
-        check_count = 0
-        max_checks = 400  # Restart worker after 400 checks to prevent memory issues
+        # Register before enumerating so no session falls between the walk and the callbacks;
+        # sessions seen by both are skipped in watch_session. The enumeration also activates
+        # the notifications, which the session manager only delivers once it has been enumerated
+        listener = NewSessionListener()
+        session_manager.RegisterSessionNotification(listener)
+        endpoints.append((session_manager, listener))
+        sessions = session_manager.GetSessionEnumerator()
         
-        while check_count < max_checks:
-            try:
-                # Get command from queue
-                command = queue.get(timeout=2)
-                
-                if command == "CHECK":
-                    result = False
-                    check_count += 1
-                    
-                    try:
-                        # Get fresh session list each time
-                        sessions = session_manager.GetSessionEnumerator()
-                        
-                        for i in range(sessions.GetCount()):
-                            try:
-                                session = sessions.GetSession(i)
-                                session2 = session.QueryInterface(IAudioSessionControl2)
-                                pid = session2.GetProcessId()
-                                
-                                # Quick process name check
-                                try:
-                                    proc = psutil.Process(pid)
-                                    if proc.name().lower() == SIPGATE_PROCESS_NAME.lower():
-                                        state = session.GetState()  # 0=inactive, 1=active
-                                        if state == 1:
-                                            result = True
-                                            break
-                                except (psutil.NoSuchProcess, psutil.AccessDenied):
-                                    continue
-                                    
-                            except Exception:
-                                # Skip problematic sessions
-                                continue
-                        
-                        queue.put(result)
-                        
-                        # Periodic cleanup to prevent memory accumulation
-                        if check_count % 50 == 0:
-                            import gc
-                            gc.collect()
-                        
-                    except Exception as e:
-                        queue.put(False)
-                        print(f"COM worker check error: {e}")
-                        
-                elif command == "EXIT":
-                    print("COM worker received EXIT command")
-                    break
-                    
-            except Exception:
-                # Timeout or other queue error - continue waiting
-                continue
+        if sipgate_pids:
+            get_session = sessions.GetSession  # Resolve the COM method once, not per session
+            for i in range(sessions.GetCount()):
+                try:
+                    session = AudioSession(get_session(i).QueryInterface(IAudioSessionControl2))
+                    pid = session.ProcessId
+                    if pid in sipgate_pids:
+                        # Collect silently; attach() publishes the combined state once
+                        watch_session(session, pid, publish=False)
+                except (COMError, OSError):
+                    # Skip sessions that vanished or can't be queried
+                    continue
+    
+    def detach():
+        """Unregister session callbacks and drop the endpoint objects"""
+        with watched_lock:
+            sessions = list(watched.values())
+            watched.clear()
+        for session in sessions:
+            with contextlib.suppress(Exception):
+                session.unregister_notification()
+        tracker.reset()  # Silent; attach() publishes the new state
+        for session_manager, listener in endpoints:
+            with contextlib.suppress(Exception):
+                session_manager.UnregisterSessionNotification(listener)
+        endpoints.clear()
+    
+    def reattach():
+        """
+        Drop the current endpoint and attach to the default one. Without a capture device
+        (E_NOTFOUND) the mic is reported inactive and the worker waits for the next
+        default-device notification or resync instead of dying.
+        """
+        detach()
+        try:
+            attach()
+        except COMError as e:
+            print(f"COM worker found no usable capture device: {e}")
+            detach()
+            tracker.publish()
+    
+    try:
+        # The enumerator lives for the whole worker; endpoint objects only change with the default device
+        enumerator = AudioUtilities.GetDeviceEnumerator()
+        device_listener = DefaultDeviceListener()
+        enumerator.RegisterEndpointNotificationCallback(device_listener)
+        reattach()
+        ready.set()
         
-        print(f"COM worker exiting after {check_count} checks (planned restart)")
+        # Callbacks run on COM threads; this loop only handles commands and the safety resync
+        while True:
+            try:
+                command = commands.get(timeout=resync_interval)
+            except queue.Empty:
+                command = "RESYNC"
+            
+            if command == "EXIT":
+                print("COM worker received stop signal")
+                break
+            elif command == "REBUILD":
+                print("COM worker re-attaching to the new default capture device")
+                reattach()
+            elif command == "RESYNC":
+                # Re-walk the sessions in case a notification was missed; publishes only on change
+                reattach()
                 
     except Exception as e:
         print(f"COM worker fatal error: {e}")
         
     finally:
-        # Cleanup COM objects
-        try:
-            if session_manager:
-                del session_manager
-            if mic:
-                del mic
-            if enumerator:
-                del enumerator
-        except:
-            pass
+        # Unregister callbacks and drop COM references before uninitializing
+        with contextlib.suppress(Exception):
+            detach()
+        if enumerator and device_listener:
+            with contextlib.suppress(Exception):
+                enumerator.UnregisterEndpointNotificationCallback(device_listener)
+        device_listener = None
+        enumerator = None
         
         # Cleanup COM
-        try:
+        with contextlib.suppress(Exception):
             pythoncom.CoUninitialize()
-        except:
-            pass
 
 # -----------------------------
-# Process-based mic checker with lifecycle management
+# Process-based mic watcher with lifecycle management
 # -----------------------------
 class ProcessSafeMicChecker:
-    def __init__(self):
+    def __init__(self, use_thread=False):
+        # A thread in its own MTA avoids the spawn cost; a process isolates native COM crashes
+        self.use_thread = use_thread
         self.process = None
-        self.queue = None
-        self.response_queue = None
-        self.worker_start_time = None
-        self.check_count = 0
-        self.max_worker_lifetime = 600  # 10 minutes before forced restart
-        self.max_checks_per_worker = 500  # Restart after 500 checks
+        self.stop_event = multiprocessing.Event()
+        # Shared single-byte flag written by the worker; no locking needed for reads
+        self.mic_active = multiprocessing.Value('b', False, lock=False)
+        self.state_changed = multiprocessing.Event()
+        self.worker_ready = multiprocessing.Event()
+        self.worker_ready_timeout = 5
+        self.active = False
+        self.worker_down = False  # Set once a dead worker has been reported, until it publishes again
+        self.liveness_interval = 0.5  # Seconds between worker liveness checks while waiting
         self.consecutive_errors = 0
-        self.max_consecutive_errors = 3
+        self.next_restart_time = 0.0  # Monotonic; restarts back off exponentially
+        self.max_restart_backoff = 30
         self.start_worker()
     
     def start_worker(self):
-        """Start the COM worker process."""
+        """Start the COM worker (process or thread)."""
         self.cleanup()  # Ensure clean state
         
-        self.queue = multiprocessing.Queue()
-        self.response_queue = multiprocessing.Queue()
+        self.stop_event.clear()
+        self.worker_ready.clear()
         
-        self.process = multiprocessing.Process(target=com_worker_process, args=(self.queue,))
-        self.process.daemon = True
+        # The multiprocessing primitives work the same when shared with a thread
+        worker_type = threading.Thread if self.use_thread else multiprocessing.Process
+        self.process = worker_type(
+            target=com_worker_process,
+            args=(self.stop_event, self.mic_active, self.state_changed, self.worker_ready,
+                  SIPGATE_NAME_LOWER, SESSION_RESYNC_INTERVAL),
+            daemon=True
+        )
         self.process.start()
-        self.worker_start_time = time.time()
-        self.check_count = 0
-        self.consecutive_errors = 0
-        logging.info("Started COM worker process")
-    
-    def should_restart_worker(self):
-        """Check if worker should be restarted for maintenance."""
-        if not self.process or not self.process.is_alive():
-            return True
         
-        current_time = time.time()
-        
-        # Restart if worker has been running too long
-        if self.worker_start_time and (current_time - self.worker_start_time) > self.max_worker_lifetime:
-            logging.info(f"Worker restart due to age: {current_time - self.worker_start_time:.0f}s")
-            return True
-        
-        # Restart if too many checks have been performed
-        if self.check_count > self.max_checks_per_worker:
-            logging.info(f"Worker restart due to check count: {self.check_count}")
-            return True
-        
-        # Restart if too many consecutive errors
-        if self.consecutive_errors >= self.max_consecutive_errors:
-            logging.info(f"Worker restart due to consecutive errors: {self.consecutive_errors}")
-            return True
-        
-        return False
+        # Wait for the worker to confirm it is attached instead of guessing with a sleep,
+        # but stop waiting as soon as it exits (e.g. COM failed to initialize)
+        deadline = time.monotonic() + self.worker_ready_timeout
+        while not self.worker_ready.wait(0.1):
+            if not self.process.is_alive():
+                logging.warning("COM worker exited during startup")
+                return
+            if time.monotonic() >= deadline:
+                logging.warning(f"COM worker not ready after {self.worker_ready_timeout}s")
+                return
+        logging.info(f"Started COM worker {'thread' if self.use_thread else 'process'}")
     
-    def check_mic(self):
-        """Check if Sipgate mic is active using the worker process."""
-        # Proactive worker maintenance
-        if self.should_restart_worker():
-            logging.info("Performing preventive worker restart...")
-            self.start_worker()
-            time.sleep(1)  # Give it time to initialize
-        
-        try:
-            # Clear any old responses with timeout
-            clear_attempts = 0
-            while not self.queue.empty() and clear_attempts < 10:
-                try:
-                    self.queue.get_nowait()
-                    clear_attempts += 1
-                except:
-                    break
-            
-            # Send check command
-            self.queue.put("CHECK")
-            self.check_count += 1
-            
-            # Wait for response (with timeout)
-            result = self.queue.get(timeout=3)
-            self.consecutive_errors = 0  # Reset on success
-            return result
-            
-        except Exception as e:
-            self.consecutive_errors += 1
-            logging.error(f"Error checking mic (consecutive: {self.consecutive_errors}): {e}")
-            
-            # Don't restart immediately on first error, give it a chance
-            if self.consecutive_errors >= 2:
-                logging.warning("Multiple consecutive errors, restarting worker...")
-                self.start_worker()
-                time.sleep(1)
-            
-            return False
+    def worker_alive(self):
+        return self.process is not None and self.process.is_alive()
+    
+    def wait_for_change(self, timeout):
+        """
+        Block until the worker reports a new mic state or the timeout expires.
+        Returns the latest known state of the Sipgate mic, or None while the worker is down.
+        The wait is sliced so a dead worker is noticed and restarted (with backoff) promptly.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if not self.worker_alive():
+                if not self.worker_down:
+                    # Report the outage right away; the last published state can't be trusted
+                    self.worker_down = True
+                    logging.warning("COM worker is not running")
+                    return None
+                if now >= self.next_restart_time:
+                    self._restart_worker(now)
+                    continue
+            
+            remaining = deadline - now
+            if remaining <= 0:
+                return None if self.worker_down else self.active
+            
+            # Clear before reading so a change published meanwhile triggers the next wait
+            if self.state_changed.wait(min(remaining, self.liveness_interval)):
+                self.state_changed.clear()
+                self.active = bool(self.mic_active.value)
+                self.worker_down = False
+                self.consecutive_errors = 0  # Reset once the worker is reporting
+                return self.active
+    
+    def _restart_worker(self, now):
+        """Restart the worker and schedule the earliest next attempt (capped exponential backoff)"""
+        self.consecutive_errors += 1
+        backoff = min(2 ** min(self.consecutive_errors, 10), self.max_restart_backoff)
+        backoff += random.uniform(0, 0.1 * backoff)  # Jitter so restarts don't lock step with a failing driver
+        self.next_restart_time = now + backoff
+        logging.warning(f"Restarting COM worker (consecutive: {self.consecutive_errors}, "
+                        f"next attempt no sooner than {backoff:.1f}s)...")
+        self.start_worker()
     
     def cleanup(self):
-        """Clean up the worker process."""
+        """Clean up the worker process or thread."""
         if self.process and self.process.is_alive():
             try:
                 # Try graceful shutdown first
-                if hasattr(self, 'queue') and self.queue:
-                    try:
-                        self.queue.put("EXIT", timeout=1)
-                    except:
-                        pass
+                self.stop_event.set()
+                self.process.join(timeout=2)
                 
-                # Wait for graceful exit
-                self.process.join(timeout=3)
+                # Threads can't be killed; a stuck daemon thread is abandoned
+                if self.use_thread:
+                    if self.process.is_alive():
+                        logging.warning("COM worker thread did not stop, abandoning it")
                 
                 # Force termination if needed
-                if self.process.is_alive():
+                elif self.process.is_alive():
                     logging.warning("Force terminating unresponsive worker...")
                     self.process.terminate()
                     self.process.join(timeout=3)
@@ -474,187 +724,193 @@ class ProcessSafeMicChecker:
             
             finally:
                 self.process = None
-                
-        # Clean up queues
-        if hasattr(self, 'queue') and self.queue:
-            try:
-                self.queue.close()
-            except:
-                pass
-        if hasattr(self, 'response_queue') and self.response_queue:
-            try:
-                self.response_queue.close()
-            except:
-                pass
 
 # -----------------------------
-# Alternative: WMI-based checker (fallback)
+# Alternative: process-based checker (fallback)
 # -----------------------------
-def check_sipgate_mic_wmi():
+def check_sipgate_mic_fallback(sipgate_name=SIPGATE_NAME_LOWER):
     """
-    Alternative method using WMI to check audio sessions.
-    This is a fallback if COM continues to fail.
+    Fallback if COM continues to fail: reports the mic as active while Sipgate is running.
+    Less accurate than the session state, but needs no COM at all.
     """
     try:
-        import wmi
-        c = wmi.WMI()
-        
-        # Check if Sipgate process exists and has audio
-        for process in c.Win32_Process(Name=SIPGATE_PROCESS_NAME):
-            # If process exists, we assume it might be in a call
-            # This is less accurate but more stable
-            return True
-        return False
-    except:
+        return any(
+            p.info['name'] and p.info['name'].lower() == sipgate_name
+            for p in psutil.process_iter(['name'])
+        )
+    except psutil.Error:
         return False
 
 # -----------------------------
-# Helper: call OBS control script
+# Helper: send action to the persistent OBS controller
 # -----------------------------
-def call_obs(action, renamer=None):
-    if action.lower() not in ("start", "stop"):
-        return
+def call_obs(obs, action, renamer=None):
+    """Submit action to OBS and return its future (None if it could not be sent)"""
+    action = action.lower()
+    if action not in ("start", "stop"):
+        return None
     try:
-        subprocess.Popen([PYTHON_EXE, OBS_CONTROL_SCRIPT, action])
+        future = obs.call(action)
         logging.info(f"Called OBS control with action: {action}")
         
         # Mark recording start time for file tracking
-        if action.lower() == "start" and renamer:
+        if action == "start" and renamer:
             renamer.mark_recording_start()
+        
+        return future
             
     except Exception as e:
         logging.error(f"Failed to call OBS control: {e}")
+        return None
+
+# -----------------------------
+# Call states for the main loop
+# -----------------------------
+class CallState(enum.Enum):
+    IDLE = enum.auto()       # No Sipgate mic activity
+    DETECTED = enum.auto()   # Mic active, not yet longer than the call duration threshold
+    CALL = enum.auto()       # Real call, waiting for the recording delay
+    RECORDING = enum.auto()  # OBS is recording
+    STOPPING = enum.auto()   # Recording, mic dropped; waiting out the stop debounce
 
 # -----------------------------
 # Main loop with process isolation and duration threshold
 # -----------------------------
-def main():
+def main(cfg):
+    poll_interval = cfg["poll_interval"]
+    recording_delay = cfg["recording_delay"]
+    call_duration_threshold = cfg["call_duration_threshold"]
+    stop_debounce = cfg.get("stop_debounce", 0.5)
+    
     logging.info("="*50)
     logging.info("Starting Sipgate mic monitor (Process-Isolated Version)")
     logging.info(f"Python version: {sys.version}")
-    logging.info(f"Poll interval: {POLL_INTERVAL}s, Recording delay: {RECORDING_DELAY}s")
-    logging.info(f"Call duration threshold: {CALL_DURATION_THRESHOLD}s")
+    logging.info(f"Poll interval: {poll_interval}s, Recording delay: {recording_delay}s")
+    logging.info(f"Call duration threshold: {call_duration_threshold}s, Stop debounce: {stop_debounce}s")
     logging.info("="*50)
     
-    recording = False
-    last_mem_log = 0
-    error_count = 0
-    max_consecutive_errors = 10
-    use_fallback = False
+    state = CallState.IDLE
+    last_mem_log = float('-inf')  # Log status on the first iteration
+    
+    # Timestamps (monotonic) for the duration threshold and the stop debounce
+    call_start_time = 0.0
+    inactive_since = 0.0
     
-    # Duration threshold variables
-    call_start_time = None
-    call_detection_logged = False
+    # Prime the CPU counter so the non-blocking status reading is meaningful
+    SELF_PROCESS.cpu_percent(interval=None)
     
     # Create the process-safe mic checker
-    mic_checker = ProcessSafeMicChecker()
+    mic_checker = ProcessSafeMicChecker(use_thread=cfg.get("com_worker_mode", "process") == "thread")
     
     # Create the recording renamer
-    renamer = RecordingRenamer(RECORDING_DIR)
+    renamer = RecordingRenamer(cfg["obs_recording_path"])
+    
+    # Keep one OBS WebSocket connection for the lifetime of the monitor
+    # (imported here so the spawned COM worker never loads the WebSocket client)
+    from obs_control import ObsController
+    obs = ObsController()
     
     try:
         while True:
-            current_time = time.time()
+            # Wait exactly until the current state's next deadline;
+            # otherwise wait for mic events (or poll the fallback while the COM worker is down)
+            now = time.monotonic()
+            match state:
+                case CallState.DETECTED:
+                    timeout = max(call_duration_threshold - (now - call_start_time), 0)
+                case CallState.CALL:
+                    timeout = max(recording_delay - (now - call_start_time), 0)
+                case CallState.STOPPING:
+                    timeout = max(stop_debounce - (now - inactive_since), 0)
+                case _:
+                    timeout = poll_interval if mic_checker.worker_down else STATUS_LOG_INTERVAL
             
             try:
-                # Check mic status
-                if not use_fallback:
-                    try:
-                        active = mic_checker.check_mic()
-                        error_count = 0  # Reset on success
-                    except Exception as e:
-                        error_count += 1
-                        logging.error(f"Mic check failed ({error_count}/{max_consecutive_errors}): {e}")
-                        
-                        if error_count >= max_consecutive_errors:
-                            logging.warning("Too many COM errors, switching to fallback method")
-                            use_fallback = True
-                            active = check_sipgate_mic_wmi()
-                        else:
-                            active = False
-                else:
-                    # Use fallback WMI method
-                    active = check_sipgate_mic_wmi()
+                # Wait for mic status
+                active = mic_checker.wait_for_change(timeout)
+                if active is None:
+                    # COM worker down: without session data the fallback may only keep a running
+                    # recording going while Sipgate is up; it never starts a recording on its own
+                    active = state is CallState.RECORDING and check_sipgate_mic_fallback()
                 
             except Exception as e:
                 logging.exception(f"Critical error in mic check: {e}")
                 active = False
+                time.sleep(min(timeout, poll_interval))  # Don't spin if the error repeats
+
+            # Monotonic clock for all durations so wall-clock adjustments can't end or extend calls
+            current_time = time.monotonic()
 
             try:
-                # Handle audio activity with duration threshold
-                if active:
-                    if call_start_time is None:
-                        # First detection of audio activity
+                # Transitions driven by mic state changes
+                match (state, active):
+                    case (CallState.IDLE, True):
                         call_start_time = current_time
-                        call_detection_logged = False
-                        
-                    
-                    # Check if audio has been active long enough to be considered a call
-                    call_duration = current_time - call_start_time
-                    
-                    if call_duration >= CALL_DURATION_THRESHOLD:
-                        # This is now considered a real call
-                        if not call_detection_logged:
-                            logging.info("Audio activity detected: Checking duration...")
-                            call_detection_logged = True
-                        
-                        # Check if we should start recording (after recording delay)
-                        if not recording and call_duration >= RECORDING_DELAY:
-                            logging.info("Call answered: Starting OBS recording")
-                            call_obs("start", renamer)
-                            recording = True
-                
-                else:  # No microphone activity
-                    if call_start_time is not None:
+                        state = CallState.DETECTED
+                    case (CallState.DETECTED | CallState.CALL, False):
                         call_duration = current_time - call_start_time
-                        
-                        if call_duration < CALL_DURATION_THRESHOLD:
-                            # Audio was too brief, ignore it
-                            pass
-                        else:
-                            # This was a real call that has now ended
-                            if recording:
-                                logging.info("Call ended: Stopping OBS recording")
-                                call_obs("stop")
-                                recording = False
-                                
-                                # Launch rename dialog in a separate thread to avoid blocking
-                                time.sleep(2)  # Give OBS time to finalize the file
-                                logging.info("Launching rename dialog...")
-                                rename_thread = threading.Thread(target=renamer.handle_recording_rename)
-                                rename_thread.daemon = True
-                                rename_thread.start()
-                            else:
-                                logging.info(f"Call session ended without recording (duration: {call_duration:.1f}s)")
-                        
-                        # Reset call tracking variables
-                        call_start_time = None
-                        call_detection_logged = False
+                        # Audio shorter than the threshold is ignored silently
+                        if call_duration >= call_duration_threshold:
+                            logging.info(f"Call session ended without recording (duration: {call_duration:.1f}s)")
+                        state = CallState.IDLE
+                    case (CallState.RECORDING, False):
+                        # Ride out short drops (hold/transfer) instead of stopping and restarting OBS
+                        inactive_since = current_time
+                        state = CallState.STOPPING
+                    case (CallState.STOPPING, True):
+                        state = CallState.RECORDING
+                
+                # Transitions driven by elapsed time
+                if state is CallState.DETECTED and current_time - call_start_time >= call_duration_threshold:
+                    # This is now considered a real call
+                    logging.info("Audio activity detected: Checking duration...")
+                    state = CallState.CALL
+                
+                if state is CallState.CALL and current_time - call_start_time >= recording_delay:
+                    logging.info("Call answered: Starting OBS recording")
+                    call_obs(obs, "start", renamer)
+                    state = CallState.RECORDING
+                
+                if state is CallState.STOPPING and current_time - inactive_since >= stop_debounce:
+                    logging.info("Call ended: Stopping OBS recording")
+                    stop_future = call_obs(obs, "stop")
+                    state = CallState.IDLE
+                    
+                    # Launch rename dialog in a separate thread to avoid blocking;
+                    # it waits for OBS to finish stopping before looking for the file
+                    logging.info("Launching rename dialog...")
+                    rename_thread = threading.Thread(
+                        target=renamer.handle_recording_rename, args=(stop_future,)
+                    )
+                    rename_thread.daemon = True
+                    rename_thread.start()
 
             except Exception as e:
                 logging.exception(f"Error in call state logic: {e}")
 
             # Periodic status logging
-            if current_time - last_mem_log >= 60:
+            if current_time - last_mem_log >= STATUS_LOG_INTERVAL:
                 try:
-                    process = psutil.Process(os.getpid())
-                    mem_mb = process.memory_info().rss / 1024**2
-                    cpu_percent = process.cpu_percent(interval=0.1)
-                    method = "Fallback/WMI" if use_fallback else "COM/Process"
+                    with SELF_PROCESS.oneshot():  # One batch of process queries for both values
+                        mem_mb = SELF_PROCESS.memory_info().rss / 1024**2
+                        cpu_percent = SELF_PROCESS.cpu_percent(interval=None)  # Since last call, non-blocking
+                    method = "Fallback/psutil" if mic_checker.worker_down else "COM/Events"
                     logging.info(f"Status - Memory: {mem_mb:.2f} MB, CPU: {cpu_percent:.1f}%, "
-                               f"Recording: {recording}, Method: {method}")
+                               f"State: {state.name}, Method: {method}")
                 except Exception as e:
                     logging.error(f"Could not log stats: {e}")
+                # Do the full collection now, while idle, instead of mid-transition
+                if state is CallState.IDLE:
+                    gc.collect(2)
                 last_mem_log = current_time
 
-            time.sleep(POLL_INTERVAL)
-
     except KeyboardInterrupt:
         logging.info("Stopping monitoring (KeyboardInterrupt)")
 
     finally:
         logging.info("Performing cleanup...")
         mic_checker.cleanup()
+        obs.close()
         logging.info("Sipgate mic monitor stopped")
 
 # -----------------------------
@@ -665,12 +921,17 @@ if __name__ == "__main__":
     if sys.platform == "win32":
         multiprocessing.set_start_method('spawn', force=True)
     
+    # Move the import-time objects out of the collector's view once per process, not per restart
+    gc.collect()
+    gc.freeze()
+    
     max_restarts = 5
     restart_count = 0
     
     while restart_count < max_restarts:
         try:
-            main()
+            # Re-read config.json only if it was edited since the last (re)start
+            main(config.load())
             break
             
         except SystemExit:
@@ -693,7 +954,7 @@ if __name__ == "__main__":
                     with open("CRASH_MARKER.txt", "w") as f:
                         f.write(f"Crashed {max_restarts} times. Last error: {str(e)}\n")
                         f.write(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-                except:
+                except OSError:
                     pass
                     
                 sys.exit(1)
\ No newline at end of file